@@ -1,24 +1,55 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
+import io
 import os
 import time
-import thread
+import zlib
+import json
+import hashlib
+import tempfile
 import yaml
+import urllib3
+import requests
+
+try:
+    from yaml import CSafeLoader as _Loader, CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeLoader as _Loader, SafeDumper as _Dumper
 
 # ROS libs
 import rospy
-from sensor_msgs.msg import CompressedImage, CameraInfo
+import rospkg
+from sensor_msgs.msg import CompressedImage, CameraInfo, Image
 from sensor_msgs.srv import SetCameraInfo, SetCameraInfoResponse
 
 # Foscam libs
-from libpyfoscam import FoscamCamera, FOSCAM_SUCCESS, FoscamError
+from libpyfoscam.foscam import FoscamCamera, FOSCAM_SUCCESS, FoscamError
 
 # Duckietown libs
 from duckietown import DTROS
 
+# GPU JPEG decoder (optional, only needed with ~decode_gpu)
+try:
+    from nvjpeg import NvJpeg
+except ImportError:
+    NvJpeg = None
+
+# Seconds to wait for the camera before giving up on the stream
+STREAM_TIMEOUT_SECS = 5.0
+# Seconds to wait before reopening a broken stream
+STREAM_RETRY_SECS = 1.0
+# Minimum seconds between two repeated warnings
+LOG_THROTTLE_SECS = 5.0
+# Seconds between two CameraInfo messages when not synced with the images
+CAMERA_INFO_PERIOD_SECS = 1.0
+# Value of the sub stream format for MJPEG in the Foscam CGI API
+SUB_STREAM_FORMAT_MJPEG = 1
+# Size of the read buffer of the stream (bytes)
+STREAM_BUFFER_SIZE = 256 * 1024
+
 
 class FoscamCameraNode(DTROS):
     """
-    This ROS node takes a stream of images from a Foscam IP camera using the HTTP CGI API
+    This ROS node takes the MJPEG stream of a Foscam IP camera using the HTTP CGI API
     provided by such cameras and turns it into a stream of CompressedImage ROS messages.
 
     Args:
@@ -31,9 +62,13 @@ class FoscamCameraNode(DTROS):
         ~username (:obj:`float`): The username to login into the camera
         ~password (:obj:`float`): The password to login into the camera
         ~framerate (:obj:`float`): The maximum camera image acquisition framerate, defaults to the max supported by the camera
+        ~decode_gpu (:obj:`bool`): Whether to decode the images on the GPU (nvJPEG) and publish them raw, defaults to `False`
+        ~sync_camera_info (:obj:`bool`): Whether to publish the camera info with every image (needed by image_proc), otherwise it is published once per second, defaults to `True`
 
     Publisher:
         ~image/compressed (:obj:`CompressedImage`): The acquired camera images
+        ~image/raw (:obj:`Image`): The acquired camera images decoded on the GPU, only with `~decode_gpu`
+        ~camera_info (:obj:`CameraInfo`): The camera calibration (latched)
 
     Service:
         ~set_camera_info:
@@ -47,7 +82,7 @@ class FoscamCameraNode(DTROS):
 
     def __init__(self, node_name, camera_name):
         # Initialize the DTROS parent class
-        super(FoscamCameraNode, self).__init__(node_name=node_name)
+        super().__init__(node_name=node_name)
 
         # Add the node parameters to the parameters dictionary and load their default values
         self.camera_name = camera_name
@@ -58,8 +93,20 @@ class FoscamCameraNode(DTROS):
         self.parameters['~framerate'] = None
         self.updateParameters()
 
+        # Optional parameters, read with defaults so that older configuration files keep working
+        self.decode_gpu = rospy.get_param('~decode_gpu', False)
+        self.sync_camera_info = rospy.get_param('~sync_camera_info', True)
+
+        # Setup the HTTP session used for the stream
+        self.session = requests.Session()
+
         # Setup FoscamCamera
         self.image_msg = CompressedImage()
+        self.image_msg.format = "jpeg"
+        self.raw_image_msg = Image()
+        self.raw_image_msg.encoding = "bgr8"
+        self.pub_raw_img = None
+        self._last_stream_warning = None
         self.initializeCamera()
 
         # For intrinsic calibration
@@ -72,14 +119,32 @@ class FoscamCameraNode(DTROS):
             msg = "Can't find calibration file: %s.\n Aborting!" % self.cali_file
             rospy.signal_shutdown(msg)
 
+        # Digest of the last calibration saved, used to skip identical writes
+        self._last_calib_sha = None
+
         # Load the calibration file
         self.camera_info = self.loadCameraInfo(self.cali_file)
         self.log("Using calibration file: %s" % self.cali_file)
 
+        # The frame ID never changes, set it once on the reused messages
+        self.camera_info.header.frame_id = self.frame_id
+        self.image_msg.header.frame_id = self.frame_id
+        self.raw_image_msg.header.frame_id = self.frame_id
+
         # Setup publishers
         self.has_published = False
-        self.pub_img = self.publisher("~image/compressed", CompressedImage, queue_size=1)
-        self.pub_camera_info = self.publisher("~camera_info", CameraInfo, queue_size=1)
+        self.pub_img = self.publisher("~image/compressed", CompressedImage,
+                                      queue_size=1, tcp_nodelay=True)
+        self.pub_camera_info = self.publisher("~camera_info", CameraInfo,
+                                              queue_size=1, latch=True)
+
+        # Publish the CameraInfo once so that late subscribers get it before the first frame
+        self.camera_info.header.stamp = rospy.Time.now()
+        self.pub_camera_info.publish(self.camera_info)
+
+        # Publish the CameraInfo periodically when it is not published with every image
+        self.timer_camera_info = rospy.Timer(rospy.Duration(CAMERA_INFO_PERIOD_SECS),
+                                             self.cbCameraInfoTimer)
 
         # Setup service (for camera_calibration)
         self.srv_set_camera_info = rospy.Service("~set_camera_info",
@@ -89,13 +154,37 @@ class FoscamCameraNode(DTROS):
         self.log("Initialized.")
 
     def initializeCamera(self):
+        # minimum time between two published frames
+        self._period = 1.0 / float(self.parameters['~framerate'])
         self.camera = FoscamCamera(
             self.parameters['~ip'],
             self.parameters['~port'],
             self.parameters['~username'],
             self.parameters['~password'],
-            daemon=False
+            daemon=False,
+            # the library prints every command URL, credentials included, when verbose
+            verbose=False
         )
+        # the MJPEG stream is served from the sub stream
+        code, _ = self.camera.set_sub_stream_format(SUB_STREAM_FORMAT_MJPEG)
+        if code != FOSCAM_SUCCESS:
+            self.log('Could not set the sub stream format to MJPEG, the API returned:\n%s'
+                     % FoscamError(code=code), 'warn')
+        # setup the GPU decoder
+        self.nj = None
+        if self.decode_gpu:
+            if NvJpeg is None:
+                self.log('GPU decoding requested but nvjpeg is not installed, '
+                         'publishing compressed images only.', 'warn')
+            else:
+                try:
+                    self.nj = NvJpeg()
+                except Exception as e:
+                    self.log('Could not initialize the GPU decoder (%s), '
+                             'publishing compressed images only.' % e, 'warn')
+                if self.nj is not None and self.pub_raw_img is None:
+                    self.pub_raw_img = self.publisher("~image/raw", Image,
+                                                      queue_size=1, tcp_nodelay=True)
 
     def startCapturing(self):
         """Initialize and closes image stream.
@@ -104,19 +193,21 @@ class FoscamCameraNode(DTROS):
             restart the image capturing.
         """
         self.log("Start capturing.")
-        stime = time.time()
-        wtime = 1.0 / float(self.parameters['~framerate'])
         while not (self.is_shutdown or rospy.is_shutdown()):
-            # adjust framerate
-            delta = time.time() - stime
-            if delta < wtime:
-                time.sleep(wtime - delta)
-            stime = time.time()
-            # try fetching a new frame from the camera
+            # stream frames from the camera until shutdown or a parameter change
             try:
-                self.grabAndPublish()
-            except FoscamError as e:
-                self.log('Error fetching frame from the camera, the API returned:\n%s' % e, 'warn')
+                self.streamAndPublish()
+            except (requests.RequestException, urllib3.exceptions.HTTPError,
+                    IOError, ValueError) as e:
+                now = time.monotonic()
+                if self._last_stream_warning is None or \
+                        now - self._last_stream_warning >= LOG_THROTTLE_SECS:
+                    # the exception message can contain the stream URL, which holds the password
+                    self.log('Error reading the stream from the camera at %s:%s (%s).' % (
+                        self.parameters['~ip'], self.parameters['~port'], type(e).__name__
+                    ), 'warn')
+                    self._last_stream_warning = now
+                time.sleep(STREAM_RETRY_SECS)
             # ---
             if self.parametersChanged:
                 # update parameters
@@ -126,35 +217,147 @@ class FoscamCameraNode(DTROS):
         # ---
         self.log("Capture Ended.")
 
-    def grabAndPublish(self):
-        """Captures a frame from stream and publishes it.
-            If the stream is stable (no shutdown requests),
-            grabs a frame, creates the image message and publishes it.
+    def streamAndPublish(self):
+        """Opens the MJPEG stream of the camera and publishes the frames it pushes.
+            A single HTTP connection is kept open for the whole stream and the camera
+            paces the frames. Frames arriving faster than the configured framerate and
+            frames identical to the previous one are dropped. Returns when the node shuts
+            down or the parameters change.
         """
-        # get time
-        stamp = rospy.Time.now()
-
-        # fetch frame
-        code, data = self.camera.snap_picture()
-        if code != FOSCAM_SUCCESS:
-            raise FoscamError(code=code)
+        url = "http://%s:%s/cgi-bin/CGIStream.cgi" % (self.parameters['~ip'],
+                                                     self.parameters['~port'])
+        params = {
+            'cmd': 'GetMJStream',
+            'usr': self.parameters['~username'],
+            'pwd': self.parameters['~password']
+        }
+        next_time = None
+        last_hash = None
+        res = self.session.get(url, params=params, stream=True, timeout=STREAM_TIMEOUT_SECS)
+        try:
+            res.raise_for_status()
+            boundary = self._getStreamBoundary(res.headers.get('Content-Type', ''))
+            stream = io.BufferedReader(res.raw, STREAM_BUFFER_SIZE)
+            for data in self._readFrames(stream, boundary):
+                if self.is_shutdown or rospy.is_shutdown() or self.parametersChanged:
+                    break
+                # adjust framerate, tolerating frames up to half a period early (jitter)
+                now = time.monotonic()
+                if next_time is not None and now < next_time - 0.5 * self._period:
+                    continue
+                # drop frames identical to the last published one
+                frame_hash = (len(data), zlib.crc32(data))
+                if frame_hash == last_hash:
+                    continue
+                last_hash = frame_hash
+                next_time = now + self._period if next_time is None \
+                    else max(next_time + self._period, now)
+                # get time
+                stamp = rospy.Time.now()
+                # publish frame
+                self.publishFrame(data, stamp)
+        finally:
+            res.close()
+
+    @staticmethod
+    def _getStreamBoundary(content_type):
+        """Extracts the multipart boundary from the Content-Type header of the stream.
+            Args:
+                content_type (:obj:`str`): value of the Content-Type header
+            Returns:
+                :obj:`bytes`: the boundary, without the leading dashes
+        """
+        mime, _, options = content_type.partition(';')
+        if mime.strip().lower() != 'multipart/x-mixed-replace':
+            raise ValueError("Unexpected stream Content-Type '%s'" % content_type)
+        for option in options.split(';'):
+            key, _, value = option.partition('=')
+            if key.strip().lower() == 'boundary':
+                return value.strip().strip('"').lstrip('-').encode('ascii')
+        raise ValueError("No boundary found in stream Content-Type '%s'" % content_type)
+
+    @staticmethod
+    def _readFrames(stream, boundary):
+        """Parses a `multipart/x-mixed-replace` stream and yields the body of each part.
+            The parts are read into a single reusable buffer, a yielded frame is only
+            valid until the next one is requested.
+            Args:
+                stream (:obj:`io.BufferedReader`): the HTTP response body
+                boundary (:obj:`bytes`): the multipart boundary, without the leading dashes
+        """
+        data = bytearray()
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            # skip everything up to the next boundary
+            if line.strip().lstrip(b'-') != boundary:
+                continue
+            # read the part headers
+            headers = {}
+            while True:
+                line = stream.readline()
+                if not line:
+                    return
+                line = line.strip()
+                if not line:
+                    break
+                key, _, value = line.partition(b':')
+                headers[key.strip().lower()] = value.strip()
+            if b'content-length' not in headers:
+                raise ValueError('Stream part without Content-Length')
+            length = int(headers[b'content-length'])
+            # read the part body
+            if len(data) < length:
+                data.extend(bytes(length - len(data)))
+            else:
+                del data[length:]
+            if stream.readinto(data) < length:
+                raise IOError('Stream closed while reading a frame')
+            yield data
+
+    def publishFrame(self, data, stamp):
+        """Publishes a frame received from the camera.
+            Fills the image message and publishes it together with the camera info.
+            Args:
+                data (:obj:`bytearray`): the JPEG frame
+                stamp (:obj:`rospy.Time`): the time the frame was received
+        """
+        # publish the compressed image
+        self.image_msg.data = data
+        self.image_msg.header.stamp = stamp
+        self.pub_img.publish(self.image_msg)
 
-        # generate and publish the compressed image
-        image_msg = CompressedImage()
-        image_msg.format = "jpeg"
-        image_msg.data = data
-        image_msg.header.stamp = stamp
-        image_msg.header.frame_id = self.frame_id
-        self.pub_img.publish(image_msg)
+        # decode on the GPU and publish the raw image
+        if self.nj is not None:
+            try:
+                image = self.nj.decode(bytes(data))
+            except Exception:
+                image = None
+            if image is None:
+                self.log('Could not decode the frame on the GPU, skipping the raw image.', 'warn')
+            else:
+                self.raw_image_msg.height, self.raw_image_msg.width = image.shape[:2]
+                self.raw_image_msg.step = image.strides[0]
+                self.raw_image_msg.data = image.tobytes()
+                self.raw_image_msg.header.stamp = stamp
+                self.pub_raw_img.publish(self.raw_image_msg)
 
         # Publish the CameraInfo message
-        self.camera_info.header.stamp = stamp
-        self.pub_camera_info.publish(self.camera_info)
+        if self.sync_camera_info:
+            self.camera_info.header.stamp = stamp
+            self.pub_camera_info.publish(self.camera_info)
 
         if not self.has_published:
             self.log("Published the first image.")
             self.has_published = True
 
+    def cbCameraInfoTimer(self, event):
+        if self.sync_camera_info:
+            return
+        self.camera_info.header.stamp = event.current_real
+        self.pub_camera_info.publish(self.camera_info)
+
     def cbSrvSetCameraInfo(self, req):
         self.log("[cbSrvSetCameraInfo] Callback!")
         response = SetCameraInfoResponse()
@@ -165,21 +368,65 @@ class FoscamCameraNode(DTROS):
     def loadCameraInfo(self, filename):
         """Loads the camera calibration files.
         Loads the intrinsic and extrinsic camera matrices.
+        The calibration values are cached in a JSON file under the ROS home directory
+        together with the path, size and modification time of the calibration file,
+        and reused as long as these still match.
         Args:
             filename (:obj:`str`): filename of calibration files.
         Returns:
             :obj:`CameraInfo`: a CameraInfo message object
         """
-        stream = file(filename, 'r')
-        calib_data = yaml.load(stream)
+        cache_file = os.path.join(rospkg.get_ros_home(), 'foscam_ros', 'calibrations',
+                                  os.path.basename(filename) + '.json')
+        calib_stat = os.stat(filename)
+        calib_key = [os.path.abspath(filename), calib_stat.st_size, calib_stat.st_mtime_ns]
+        # use the cached values if they were taken from this very calibration file
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache['key'] == calib_key:
+                return self._cameraInfoFromValues(cache['values'])
+        except Exception:
+            # missing, corrupted or incompatible cache, fall back to the calibration file
+            pass
+        # parse the calibration file
+        with open(filename, 'r') as stream:
+            calib_data = yaml.load(stream, Loader=_Loader)
+        values = {
+            'width': calib_data['image_width'],
+            'height': calib_data['image_height'],
+            'K': calib_data['camera_matrix']['data'],
+            'D': calib_data['distortion_coefficients']['data'],
+            'R': calib_data['rectification_matrix']['data'],
+            'P': calib_data['projection_matrix']['data'],
+            'distortion_model': calib_data['distortion_model']
+        }
+        cam_info = self._cameraInfoFromValues(values)
+        # refresh the cache
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            self._writeFileAtomically(
+                cache_file, lambda f: json.dump({'key': calib_key, 'values': values}, f))
+        except (OSError, TypeError, ValueError):
+            self.log("Could not write the calibration cache: %s" % cache_file, 'warn')
+        return cam_info
+
+    @staticmethod
+    def _cameraInfoFromValues(values):
+        """Creates a CameraInfo message from the calibration values.
+            Args:
+                values (:obj:`dict`): the image size, matrices and distortion model
+            Returns:
+                :obj:`CameraInfo`: a CameraInfo message object
+        """
         cam_info = CameraInfo()
-        cam_info.width = calib_data['image_width']
-        cam_info.height = calib_data['image_height']
-        cam_info.K = calib_data['camera_matrix']['data']
-        cam_info.D = calib_data['distortion_coefficients']['data']
-        cam_info.R = calib_data['rectification_matrix']['data']
-        cam_info.P = calib_data['projection_matrix']['data']
-        cam_info.distortion_model = calib_data['distortion_model']
+        cam_info.width = values['width']
+        cam_info.height = values['height']
+        cam_info.K = values['K']
+        cam_info.D = values['D']
+        cam_info.R = values['R']
+        cam_info.P = values['P']
+        cam_info.distortion_model = values['distortion_model']
         return cam_info
 
     def saveCameraInfo(self, camera_info_msg, filename):
@@ -209,20 +456,50 @@ class FoscamCameraNode(DTROS):
                                        'rows': 3,
                                        'cols': 4}}
 
-        self.log("[saveCameraInfo] calib %s" % (calib))
+        # Skip the write if the same calibration was already saved to the same file
+        calib_sha = hashlib.sha256(repr((filename, calib)).encode()).digest()
+        if calib_sha == self._last_calib_sha:
+            return True
 
         try:
-            f = open(filename, 'wt')
-            yaml.safe_dump(calib, f)
-            return True
-        except IOError:
+            self._writeFileAtomically(filename, lambda f: yaml.dump(calib, f, Dumper=_Dumper))
+        except (IOError, yaml.YAMLError):
             return False
+        self._last_calib_sha = calib_sha
+        return True
+
+    @staticmethod
+    def _writeFileAtomically(filename, write, binary=False):
+        """Writes a file through a temporary file moved in place, so it is never left half-written.
+            The file keeps the permissions of the file it replaces, or gets the default
+            ones for the current umask if it does not exist yet.
+            Args:
+                filename (:obj:`str`): the file to write
+                write (:obj:`callable`): function writing the content to the given file object
+                binary (:obj:`bool`): whether to open the file in binary mode
+        """
+        try:
+            mode = os.stat(filename).st_mode & 0o7777
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        f = tempfile.NamedTemporaryFile('wb' if binary else 'wt',
+                                        dir=os.path.dirname(filename), delete=False)
+        try:
+            with f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(f.name, mode)
+            os.replace(f.name, filename)
+        finally:
+            if os.path.exists(f.name):
+                os.remove(f.name)
 
 
 if __name__ == '__main__':
     # Initialize the node
     camera_node = FoscamCameraNode(node_name='camera', camera_name='foscam_r2')
-    # Start the image capturing in a separate thread
-    thread.start_new_thread(camera_node.startCapturing, ())
-    # Keep it spinning to keep the node alive
-    rospy.spin()
+    # Capture on the main thread, rospy serves the callbacks on its own threads
+    camera_node.startCapturing()